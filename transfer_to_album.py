@@ -5,26 +5,43 @@
 Официальный API ВК ограничен ~300 аудиозаписями.
 """
 
+import atexit
 import configparser
+import threading
 import time
 import webbrowser
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from http.cookiejar import MozillaCookieJar
+from itertools import chain, islice
+from operator import attrgetter, itemgetter
 from pathlib import Path
-from urllib.parse import urlencode
 
+import httpx
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
 from vkpymusic import Service
 
+try:
+    import orjson as _json  # Необязательно: быстрее разбирает ответы execute
+except ImportError:
+    import json as _json
+
 
 VK_API_VERSION = "5.95"
 VK_API_BASE = "https://api.vk.com/method"
+_CREATE_URL = f"{VK_API_BASE}/audio.createPlaylist"
+_EXECUTE_URL = f"{VK_API_BASE}/execute"
 BATCH_SIZE = 50
+EXECUTE_MAX_CALLS = 25  # execute выполняет до 25 вызовов API за один запрос
 PLAYLIST_MAX = 1000  # Kate API audio.addToPlaylist тихо обрезает на 1000
 CONFIG_FILE = "config_vk.ini"
 MIN_TRACKS = 500  # Меньше = не создаём плейлист (API лимит)
+COOKIE_CACHE_MAX_AGE = 24 * 60 * 60  # Сохранённые cookies старше суток не используем
+UPLOAD_WORKERS = 4  # Сколько плейлистов заполняется одновременно
 
 
 def _load_service_from_config(config_path: Path) -> Service | None:
@@ -41,9 +58,17 @@ def _load_service_from_config(config_path: Path) -> Service | None:
     return None
 
 
+_CREDS: tuple[str, str] | None = None
+
+
 def _get_credentials(service: Service) -> tuple[str, str]:
+    """(user_agent, token) Kate. Результат кэшируется — config_vk.ini читается не больше одного раза."""
+    global _CREDS
+    if _CREDS is not None:
+        return _CREDS
     try:
-        return service.user_agent, service._Service__token
+        _CREDS = service.user_agent, service._Service__token
+        return _CREDS
     except AttributeError:
         pass
     config_path = Path(__file__).parent / CONFIG_FILE
@@ -53,7 +78,8 @@ def _get_credentials(service: Service) -> tuple[str, str]:
         token = config["VK"].get("token_for_audio") or config["VK"].get("token")
         ua = config["VK"].get("user_agent", "")
         if token:
-            return ua, token
+            _CREDS = ua, token
+            return _CREDS
     raise RuntimeError("Нет токена. Получите токен через браузер (см. ниже).")
 
 
@@ -80,6 +106,15 @@ def _session_with_retry() -> requests.Session:
     return session
 
 
+# Один HTTP/2-клиент на все вызовы api.vk.com: параллельные запросы потоков идут
+# по одному TLS-соединению. User-Agent Kate подставляется в main(): токен привязан к клиенту
+_API_CLIENT = httpx.Client(
+    timeout=180.0,
+    headers={"User-Agent": BROWSER_USER_AGENT},
+    transport=httpx.HTTPTransport(http2=True, retries=5),
+)
+
+
 def _load_cookies_session(cookie_path: Path) -> requests.Session:
     """Загружает cookies из файла Netscape и возвращает сессию."""
     session = _session_with_retry()
@@ -90,15 +125,43 @@ def _load_cookies_session(cookie_path: Path) -> requests.Session:
     return session
 
 
-def _fetch_all_via_vk_api(
+def _save_cookies(session: requests.Session, cookie_path: Path) -> None:
+    """Сохраняет cookies сессии в файл Netscape (тот же формат, что читает _load_cookies_session)."""
+    jar = MozillaCookieJar(str(cookie_path))
+    for cookie in session.cookies:
+        jar.set_cookie(cookie)
+    jar.save(ignore_discard=True, ignore_expires=True)
+
+
+def _cookie_cache_path(config_path: Path) -> Path | None:
+    """Путь к кэшу cookies из config_vk.ini (cookie_cache_path) или None, если кэш выключен."""
+    config = configparser.ConfigParser()
+    if not config_path.exists():
+        return None
+    config.read(config_path, encoding="utf-8")
+    if "VK" not in config or not config["VK"].get("cookie_cache_path"):
+        return None
+    return config_path.parent / Path(config["VK"]["cookie_cache_path"]).expanduser()
+
+
+def _drop_cookie_cache(cookie_cache_path: Path | None) -> None:
+    """Удаляет кэш cookies после неудачной загрузки — следующий запуск снова спросит авторизацию."""
+    if not cookie_cache_path:
+        return
+    atexit.unregister(_save_cookies)
+    cookie_cache_path.unlink(missing_ok=True)
+
+
+def _iter_all_via_vk_api(
     user_id: int,
     *,
     login: str | None = None,
     password: str | None = None,
     cookie_path: Path | None = None,
     kate_token: str | None = None,
-) -> list[tuple[str, str]]:
-    """Парсинг m.vk.ru — получает ВСЕ треки."""
+    cookie_cache_path: Path | None = None,
+) -> Iterator[str]:
+    """Парсинг m.vk.ru — отдаёт ID ВСЕХ треков («owner_id_id») по мере загрузки, от новых к старым."""
     from vk_api import VkApi
     from vk_api.audio import VkAudio
 
@@ -113,61 +176,188 @@ def _fetch_all_via_vk_api(
         vk = VkApi(token=kate_token, session=session)
         # Не вызываем auth() — token уже есть, cookies в session
     else:
+        session = _session_with_retry()
         vk = VkApi(
             login=login or "",
             password=password or "",
-            session=_session_with_retry(),
+            session=session,
             auth_handler=two_factor_handler,
         )
         vk.auth()
 
     audio = VkAudio(vk)
     print("Загрузка треков (время зависит от количества, прогресс каждые 100)...", flush=True)
-    tracks = []
-    for track in audio.get_iter(owner_id=user_id):
-        oid = track.get("owner_id") if isinstance(track, dict) else getattr(track, "owner_id", None)
-        tid = track.get("id") if isinstance(track, dict) else getattr(track, "id", None)
+    tracks = audio.get_iter(owner_id=user_id)
+    first = next(tracks, None)
+    if first is None:
+        return
+    if cookie_cache_path:
+        # Первая страница пришла — cookies рабочие. Сохраняем сразу и при выходе,
+        # чтобы они не потерялись при падении посреди загрузки/заполнения
+        _save_cookies(session, cookie_cache_path)
+        atexit.register(_save_cookies, session, cookie_cache_path)
+    # Тип трека одинаков для всей выдачи — выбираем способ чтения полей один раз
+    get_ids = itemgetter("owner_id", "id") if isinstance(first, dict) else attrgetter("owner_id", "id")
+    count = 0
+    next_print = 100
+    for track in chain((first,), tracks):
+        try:
+            oid, tid = get_ids(track)
+        except (KeyError, AttributeError):
+            continue
         if oid is not None and tid is not None:
-            tracks.append((str(oid), str(tid)))
-        if len(tracks) % 100 == 0 and tracks:
-            print(f"  Загружено: {len(tracks)} треков...", flush=True)
-    return tracks
+            count += 1
+            yield f"{oid}_{tid}"
+            if count >= next_print:
+                print(f"  Загружено: {count} треков...", flush=True)
+                next_print += 100
 
 
-def create_playlist(service: Service, owner_id: int, title: str) -> dict:
-    user_agent, token = _get_credentials(service)
+class RateLimiter:
+    """Ограничение частоты запросов, общее для всех потоков.
+
+    Ждёт только остаток минимального интервала: если сам запрос шёл дольше, паузы нет.
+    """
+    def __init__(self, rps: float):
+        self.min_interval = 1.0 / rps
+        self.last = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self.lock:
+            wait = self.min_interval - (time.monotonic() - self.last)
+            if wait > 0:
+                time.sleep(wait)
+            self.last = time.monotonic()
+
+
+_VK_LIMITER = RateLimiter(3)  # Лимит ВК — 3 запроса в секунду
+
+
+class _UnclearResponseError(RuntimeError):
+    """Запрос мог дойти до ВК и выполниться, но ответа нет — повторять его нельзя."""
+
+
+def _api_request(method: str, url: str, **kwargs) -> dict:
+    """Запрос к api.vk.com без повторов: createPlaylist и execute не идемпотентны.
+
+    Ошибки соединения (запрос до ВК не дошёл) уже повторяет HTTPTransport(retries=...) —
+    если они остались, это RuntimeError. Таймаут чтения, обрыв потока, 5xx и не-JSON
+    ответ — _UnclearResponseError: ВК мог выполнить запрос.
+    """
+    _VK_LIMITER.acquire()
+    try:
+        resp = _API_CLIENT.request(method, url, **kwargs)
+    except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+        raise RuntimeError(f"Ошибка соединения с API: {e}") from e
+    except httpx.HTTPError as e:
+        raise _UnclearResponseError(f"Нет ответа от API: {e}") from e
+    try:
+        resp.raise_for_status()
+        return _json.loads(resp.content)
+    except (httpx.HTTPError, ValueError) as e:
+        raise _UnclearResponseError(f"Некорректный ответ API: {e}") from e
+
+
+def create_playlist(token: str, owner_id: int, title: str) -> dict:
     params = {
         "access_token": token,
         "owner_id": owner_id,
         "title": title,
         "v": VK_API_VERSION,
     }
-    resp = requests.get(
-        f"{VK_API_BASE}/audio.createPlaylist?{urlencode(params)}",
-        headers={"User-Agent": user_agent},
-    )
-    data = resp.json()
+    data = _api_request("GET", _CREATE_URL, params=params)
     if "error" in data:
         raise RuntimeError(f"Ошибка: [{data['error']['error_code']}] {data['error'].get('error_msg', '')}")
     return data["response"]
 
 
-def add_to_playlist(service: Service, owner_id: int, playlist_id: int, audio_ids: list[str]) -> None:
-    user_agent, token = _get_credentials(service)
+def add_many_batches(
+    token: str, owner_id: int, playlist_id: int, audio_id_batches: list[list[str]]
+) -> int:
+    """Добавляет до 25 батчей одним запросом execute, строго по порядку.
+
+    На первом не прошедшем батче останавливается. Возвращает, сколько батчей добавлено.
+    """
+    batches = ",".join(f'"{",".join(batch)}"' for batch in audio_id_batches)
+    # Вызов, завершившийся ошибкой, VKScript получает как false — дальше не идём,
+    # иначе следующие батчи встанут в плейлист раньше повторённого
+    code = (
+        f"var batches = [{batches}];"
+        "var i = 0;"
+        "while (i < batches.length) {"
+        f'if (!API.audio.addToPlaylist({{"owner_id":{owner_id},"playlist_id":{playlist_id},"audio_ids":batches[i]}})) {{'
+        "return i;"
+        "}"
+        "i = i + 1;"
+        "}"
+        "return i;"
+    )
     params = {
         "access_token": token,
-        "owner_id": owner_id,
-        "playlist_id": playlist_id,
-        "audio_ids": ",".join(audio_ids),
+        "code": code,
         "v": VK_API_VERSION,
     }
-    resp = requests.get(
-        f"{VK_API_BASE}/audio.addToPlaylist?{urlencode(params)}",
-        headers={"User-Agent": user_agent},
-    )
-    data = resp.json()
+    # POST: код с 25×50 ID не помещается в URL. С нужного батча _add_with_retry
+    # продолжает, только если ВК вернул счётчик; при обрыве ответа повтора нет
+    data = _api_request("POST", _EXECUTE_URL, data=params)
     if "error" in data:
         raise RuntimeError(f"Ошибка: [{data['error']['error_code']}] {data['error'].get('error_msg', '')}")
+    return data["response"]
+
+
+_PRINT_LOCK = threading.Lock()
+
+
+def _log(message: str) -> None:
+    """print для потоков загрузки: строки разных плейлистов не склеиваются."""
+    with _PRINT_LOCK:
+        print(message, flush=True)
+
+
+def _add_with_retry(
+    token: str, owner_id: int, playlist_id: int, audio_id_batches: list[list[str]]
+) -> tuple[int, bool]:
+    """Добавляет батчи по порядку; не прошедший батч повторяет один раз, затем пропускает.
+
+    Возвращает число добавленных треков и был ли повтор.
+    """
+    added = 0
+    retried = False
+    retried_batch = None
+    request_retried = False
+    pending = audio_id_batches
+    while pending:
+        try:
+            done = add_many_batches(token, owner_id, playlist_id, pending)
+        except _UnclearResponseError as e:
+            # ВК мог выполнить часть вызовов — повтор продублировал бы треки
+            lost = sum(len(batch) for batch in pending)
+            _log(f"  Ошибка: {e}. Неизвестно, добавлены ли {lost} треков — проверьте плейлист")
+            break
+        except RuntimeError as e:
+            # execute не выполнялся (ошибка ВК или нет соединения) — ни один батч не добавлен
+            if request_retried:
+                lost = sum(len(batch) for batch in pending)
+                _log(f"  Ошибка: {e}. Не добавлено {lost} треков")
+                break
+            request_retried = True
+            retried = True
+            time.sleep(2)
+            continue
+        added += sum(len(batch) for batch in pending[:done])
+        pending = pending[done:]
+        if not pending:
+            break
+        if pending[0] is retried_batch:
+            _log(f"  Ошибка: не добавлено {len(pending[0])} треков")
+            pending = pending[1:]
+            continue
+        # Повтор начинается с не прошедшего батча — порядок треков сохраняется
+        retried_batch = pending[0]
+        retried = True
+        time.sleep(2)
+    return added, retried
 
 
 def main():
@@ -196,6 +386,9 @@ def main():
             config.write(f)
         print("Токен сохранён.\n")
 
+    user_agent, token = _get_credentials(service)
+    _API_CLIENT.headers["User-Agent"] = user_agent
+
     user_info = service.get_user_info()
     user_id = user_info.userid
     print(f"Пользователь: {user_info.first_name} {user_info.last_name} (id: {user_id})\n")
@@ -204,14 +397,23 @@ def main():
     if not playlist_title:
         return
 
-    print("\nДля загрузки списка треков нужна авторизация:")
-    print("  — Логин и пароль, либо")
-    print("  — Cookies из браузера (если код 2FA не приходит, см. README)")
-    print()
-    use_cookies = input("Путь к cookies.txt (Enter = логин/пароль): ").strip()
-    cookie_path = Path(use_cookies).expanduser() if use_cookies else None
+    cookie_cache_path = _cookie_cache_path(config_path)
     login = None
     password = None
+    if (
+        cookie_cache_path
+        and cookie_cache_path.exists()
+        and time.time() - cookie_cache_path.stat().st_mtime < COOKIE_CACHE_MAX_AGE
+    ):
+        print(f"\nИспользую cookies прошлого запуска: {cookie_cache_path}")
+        cookie_path = cookie_cache_path
+    else:
+        print("\nДля загрузки списка треков нужна авторизация:")
+        print("  — Логин и пароль, либо")
+        print("  — Cookies из браузера (если код 2FA не приходит, см. README)")
+        print()
+        use_cookies = input("Путь к cookies.txt (Enter = логин/пароль): ").strip()
+        cookie_path = Path(use_cookies).expanduser() if use_cookies else None
     if not cookie_path or not cookie_path.exists():
         cookie_path = None
         print("Введите логин и пароль:")
@@ -220,92 +422,91 @@ def main():
         if not login or not password:
             print("Логин и пароль обязательны.")
             return
-    else:
+    elif cookie_path != cookie_cache_path:
         login = input("Логин (email или телефон): ").strip() or "cookies"
 
     kate_token = None
     if cookie_path:
-        _, kate_token = _get_credentials(service)
+        kate_token = token
         if not kate_token:
             print("Для cookies нужен Kate-токен в config_vk.ini.")
             return
 
+    # ВК отдаёт треки от новых к старым, а добавлять нужно от старых к новым,
+    # поэтому загрузку нельзя совместить с заполнением: первый батч — это последние треки.
+    # extendleft разворачивает поток прямо при чтении, без отдельного прохода reverse().
+    audio_ids: deque[str] = deque()
+    used_cookie_cache = cookie_cache_path is not None and cookie_path == cookie_cache_path
     try:
-        all_tracks = _fetch_all_via_vk_api(
+        audio_ids.extendleft(_iter_all_via_vk_api(
             user_id,
             login=login,
             password=password,
             cookie_path=cookie_path,
             kate_token=kate_token,
-        )
+            cookie_cache_path=cookie_cache_path,
+        ))
     except Exception as e:
+        # Кэш плох, только если он и использовался, и не отдал даже первой страницы.
+        # Если страница пришла, cookies рабочие — упала уже загрузка (например, сеть)
+        if used_cookie_cache and not audio_ids:
+            _drop_cookie_cache(cookie_cache_path)
         print(f"\nОшибка: {e}")
         print("Плейлист не создан.")
         return
 
-    if len(all_tracks) < MIN_TRACKS:
-        print(f"\nПолучено {len(all_tracks)} треков (минимум {MIN_TRACKS} для продолжения).")
+    if len(audio_ids) < MIN_TRACKS:
+        # Файл кэша записан в этом запуске (пришёл хотя бы один трек) или из него
+        # и взяты cookies — в обоих случаях с ними получается слишком мало треков
+        if used_cookie_cache or audio_ids:
+            _drop_cookie_cache(cookie_cache_path)
+        print(f"\nПолучено {len(audio_ids)} треков (минимум {MIN_TRACKS} для продолжения).")
         print("Официальный API ВК отдаёт только ~300. Используйте cookies (см. README).")
         return
 
-    print(f"\nВсего треков: {len(all_tracks)}")
-    all_tracks.reverse()
-
-    audio_ids = [f"{o}_{t}" for o, t in all_tracks]
-    print(f"\nСоздаю плейлист «{playlist_title}»...")
-    playlist_resp = create_playlist(service, user_id, playlist_title)
-    playlist_id = playlist_resp.get("id") or playlist_resp.get("playlist_id")
-    if not playlist_id:
-        print("Ошибка создания плейлиста.")
-        return
+    print(f"\nВсего треков: {len(audio_ids)}")
 
-    add_to_playlist(service, user_id, playlist_id, audio_ids[:BATCH_SIZE])
-    total_added = BATCH_SIZE
-    print(f"  Добавлено: {total_added}/{len(all_tracks)}", flush=True)
-    time.sleep(0.5)
+    tracks_iter = iter(audio_ids)
+    parts = []
+    while chunk := list(islice(tracks_iter, PLAYLIST_MAX)):
+        parts.append(chunk)
+    total_added = 0
+    added_lock = threading.Lock()
 
-    for i in range(BATCH_SIZE, min(PLAYLIST_MAX, len(audio_ids)), BATCH_SIZE):
-        batch = audio_ids[i : i + BATCH_SIZE]
+    def fill_playlist(title: str, chunk: list[str]) -> bool:
+        # Плейлисты независимы: каждый создаётся и заполняется в своём потоке.
+        # Внутри плейлиста батчи идут строго по очереди — иначе сломается порядок треков
+        nonlocal total_added
+        _log(f"Создаю плейлист «{title}»...")
         try:
-            add_to_playlist(service, user_id, playlist_id, batch)
-            total_added += len(batch)
-            print(f"  Добавлено: {total_added}/{len(all_tracks)} в «{playlist_title}»", flush=True)
+            playlist_resp = create_playlist(token, user_id, title)
         except RuntimeError as e:
-            try:
-                time.sleep(2)
-                add_to_playlist(service, user_id, playlist_id, batch)
-                total_added += len(batch)
-                print(f"  Добавлено: {total_added}/{len(all_tracks)} (повтор)", flush=True)
-            except RuntimeError:
-                print(f"  Ошибка: {e}", flush=True)
-        time.sleep(0.5)
-
-    num_playlists = 1
-    for part in range(1, (len(audio_ids) + PLAYLIST_MAX - 1) // PLAYLIST_MAX):
-        start = part * PLAYLIST_MAX
-        chunk = audio_ids[start : start + PLAYLIST_MAX]
-        title = f"{playlist_title} ({part + 1})"
-        print(f"\nСоздаю плейлист «{title}»...")
-        playlist_resp = create_playlist(service, user_id, title)
+            _log(f"  Плейлист «{title}» не создан. {e}")
+            return False
         playlist_id = playlist_resp.get("id") or playlist_resp.get("playlist_id")
         if not playlist_id:
-            continue
-        num_playlists += 1
-        for j in range(0, len(chunk), BATCH_SIZE):
-            batch = chunk[j : j + BATCH_SIZE]
-            try:
-                add_to_playlist(service, user_id, playlist_id, batch)
-                total_added += len(batch)
-                print(f"  Добавлено: {total_added}/{len(all_tracks)} в «{title}»", flush=True)
-            except RuntimeError as e:
-                try:
-                    time.sleep(2)
-                    add_to_playlist(service, user_id, playlist_id, batch)
-                    total_added += len(batch)
-                    print(f"  Добавлено: {total_added}/{len(all_tracks)} (повтор)", flush=True)
-                except RuntimeError:
-                    print(f"  Ошибка: {e}", flush=True)
-            time.sleep(0.5)
+            _log(f"  Ошибка создания плейлиста «{title}».")
+            return False
+        # При PLAYLIST_MAX = 1000 весь плейлист (20 батчей) уходит одним запросом execute
+        tracks = iter(chunk)
+        batches = iter(lambda: list(islice(tracks, BATCH_SIZE)), [])
+        while group := list(islice(batches, EXECUTE_MAX_CALLS)):
+            added, retried = _add_with_retry(token, user_id, playlist_id, group)
+            if not added:
+                continue
+            with added_lock:
+                total_added += added
+                suffix = " (повтор)" if retried else ""
+                _log(f"  Добавлено: {total_added}/{len(audio_ids)} в «{title}»{suffix}")
+        return True
+
+    print()
+    with ThreadPoolExecutor(max_workers=min(UPLOAD_WORKERS, len(parts))) as executor:
+        futures = [
+            executor.submit(fill_playlist, playlist_title if part == 0 else f"{playlist_title} ({part + 1})", chunk)
+            for part, chunk in enumerate(parts)
+        ]
+        num_playlists = sum(future.result() for future in as_completed(futures))
 
     print(f"\nГотово! Перенесено {total_added} треков в {num_playlists} плейлист(ов).")
 